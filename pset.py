@@ -1,18 +1,14 @@
 #!/usr/bin/env python3
 
+import io
 import json
 import os
-import re
 import sys
 
 try:
-    import yaml
-    YAML_AVAILABLE = True
+    import orjson
 except ImportError:
-    class yaml:
-        def __getattr__(self, name):
-            return None
-    YAML_AVAILABLE = False
+    orjson = None
 
 CONFIG_ROOTS = [".pset", "pset"]
 """List of possible base filenames for pset configuration files."""
@@ -26,37 +22,111 @@ YAML_EXTENSIONS = [".yml", ".yaml"]
 CONFIG_EXTENSIONS = JSON_EXTENSIONS + YAML_EXTENSIONS
 """List of possible file extensions for pset configuration files."""
 
-def path_is_root(path):
-    """Check if a path resolves to the root of the filesystem."""
-    canonical = os.path.realpath(path)
-    return canonical == os.path.dirname(canonical)
+CONFIG_FILENAMES = frozenset(
+    root + ext for root in CONFIG_ROOTS for ext in CONFIG_EXTENSIONS)
+"""Set of possible filenames for pset configuration files."""
+
+REPOSITORY_DIR = os.path.dirname(os.path.realpath(__file__))
+"""Absolute path to the pset repository, the directory containing pset.py."""
+
+TRUE_STRINGS = frozenset(["y", "yes", "true", "on", "1"])
+"""Set of lowercase strings which are interpreted as boolean true."""
+
+FALSE_STRINGS = frozenset(["n", "no", "false", "off", "0"])
+"""Set of lowercase strings which are interpreted as boolean false."""
 
 def repository_file(filename):
     """Return the absolute path to a file in the pset repository.
 
-    The pset repository is the directory containing pset.py, and
-    filename is resolved relative to this directory.
+    filename is resolved relative to REPOSITORY_DIR.
     """
-    this_file = os.path.realpath(__file__)
-    this_dir = os.path.dirname(this_file)
-    return os.path.join(this_dir, filename)
+    return os.path.join(REPOSITORY_DIR, filename)
 
-def print_stderr(*args, **kwargs):
+def print_stderr(*args, sep=" ", end="\n"):
     """Print a message to stderr.
 
-    args and kwargs are passed to the print function.
+    args, sep, and end are interpreted as by the print function, but
+    the message is written to stderr with a single write call.
     """
-    return print(*args, file=sys.stderr, **kwargs)
+    sys.stderr.write(sep.join(map(str, args)) + end)
+
+def reject_json_constant(name):
+    """Raise ValueError for the non-standard JSON constant name.
+
+    This is passed to the standard library parser so that it rejects
+    NaN and Infinity, like orjson does.
+    """
+    raise ValueError("invalid JSON constant: {}".format(name))
 
 def parse_json(filename):
-    """Parse a JSON file and return the parsed object."""
+    """Parse a JSON file and return the parsed object.
+
+    Use orjson if it is available, and the standard library
+    otherwise. Either way, a malformed file raises ValueError (of
+    which json.JSONDecodeError is a subclass), and so does a file
+    containing NaN or Infinity.
+    """
+    if orjson is not None:
+        with open(filename, "rb") as f:
+            return orjson.loads(f.read())
     with open(filename) as f:
-        return json.load(f)
+        return json.load(f, parse_constant=reject_json_constant)
 
 def parse_yaml(filename):
-    """Parse a YAML file and return the parsed object."""
+    """Parse a YAML file and return the parsed object.
+
+    PyYAML is imported here rather than at module level, so that it
+    is never loaded unless a YAML configuration file is actually
+    found. The libyaml-based loader is used if PyYAML was built with
+    it.
+    """
+    import yaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     with open(filename) as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=loader)
+
+PARSE_CACHE = {}
+"""Map from filenames to their stat keys and parsed contents.
+
+Used by parse_cached.
+"""
+
+def parse_cached(filename, parse):
+    """Parse a file using the function parse, with caching.
+
+    The file is only parsed again if its modification time or size
+    has changed since the last call for the same filename. The
+    returned object is shared between callers and must not be
+    modified.
+    """
+    stat = os.stat(filename)
+    stat_key = (stat.st_mtime_ns, stat.st_size)
+    cached = PARSE_CACHE.get(filename)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
+    result = parse(filename)
+    PARSE_CACHE[filename] = (stat_key, result)
+    return result
+
+def find_config_files(directory):
+    """Return the paths to the pset configuration files for directory.
+
+    The directory and each of its ancestors are searched, in that
+    order. Within each directory, files are sorted by name.
+    """
+    paths = []
+    cur_dir = os.path.realpath(directory)
+    while True:
+        with os.scandir(cur_dir) as it:
+            entries = [entry for entry in it
+                       if entry.name in CONFIG_FILENAMES and entry.is_file()]
+        entries.sort(key=lambda entry: entry.name)
+        paths.extend(entry.path for entry in entries)
+        parent_dir = os.path.dirname(cur_dir)
+        if parent_dir == cur_dir:
+            break
+        cur_dir = parent_dir
+    return paths
 
 class UserError(Exception):
     """Error thrown when the user does something wrong."""
@@ -75,19 +145,39 @@ class Config:
         After construction, configuration data may be queried
         immediately.
         """
+        self.accessed_keys = set()
+        self.ignored_keys = {}
         self.read_config_descriptions()
         self.read_default_config()
         self.read_user_config()
         self.read_command_line_arguments()
-        self.ignored = set()
+        self.collect_sources()
+        self.warn_unknown()
+
+    def collect_sources(self):
+        """Store the configuration sources in the order they are checked.
+
+        The sources are stored in the tuple sources, whose elements
+        are tuples of a configuration map, a string identifying it for
+        use in warning messages, and whether warnings about it should
+        be fatal (see the warn method). The default configuration is
+        always the last source.
+        """
+        self.sources = (
+            (self.cl_config, " from command-line arguments", False),
+            *((cfg, " from '{}'".format(fname), False)
+              for fname, cfg in self.user_configs),
+            (self.default_config, " from default config", True),
+        )
 
     def read_config_descriptions(self):
-        """Read and store configuration schema description from desc.json.
+        """Read and store the set of configuration keys from desc.json.
 
         The schema is not validated. Loading an invalid schema results
         in undefined behavior.
         """
-        self.config_keys = parse_json(repository_file("desc.json"))
+        self.config_keys = frozenset(
+            parse_cached(repository_file("desc.json"), parse_json))
 
     def read_default_config(self):
         """Read and store default configuration.
@@ -103,23 +193,16 @@ class Config:
             del self.warn_fatal
 
     def read_user_config(self):
+        """Read and store configuration from user-created files.
+
+        All the files are located first (see find_config_files), and
+        then they are loaded one after another.
+        """
         try:
             self.warn_fatal = False
             self.user_configs = []
-            cur_dir = os.getcwd()
-            while True:
-                cur_dir = os.path.realpath(cur_dir)
-                filenames = sorted(os.listdir(cur_dir))
-                for filename in filenames:
-                    for root in CONFIG_ROOTS:
-                        for ext in CONFIG_EXTENSIONS:
-                            if filename == root + ext:
-                                path = os.path.join(cur_dir, filename)
-                                self.user_configs.append(
-                                    (path, self.load_config_file(path)))
-                if path_is_root(cur_dir):
-                    break
-                cur_dir = os.path.split(cur_dir)[0]
+            for path in find_config_files(os.getcwd()):
+                self.user_configs.append((path, self.load_config_file(path)))
         finally:
             del self.warn_fatal
 
@@ -130,43 +213,51 @@ class Config:
         warn function. If the warn function does not throw an error,
         make an effort to extract as much useful data as possible from
         malformed configuration file.
+
+        Unknown keys are not reported here, but by warn_unknown once
+        all the configuration has been read.
+
+        The file is only parsed again if it has changed since it was
+        last loaded (see parse_cached), and the returned data must not
+        be modified.
         """
-        try:
-            ext = os.path.splitext(filename)[1]
-            if ext in YAML_EXTENSIONS:
-                if YAML_AVAILABLE:
-                    config = parse_yaml(filename)
-                else:
-                    self.warn("Ignoring '{}' because PyYAML is not available"
-                              .format(filename))
-                    return {}
-            elif ext in JSON_EXTENSIONS:
-                config = parse_json(filename)
-            else:
-                raise AssertionError("Unexpected file extension for file '{}'"
-                                     .format(filename))
-        except (json.JSONDecodeError, yaml.YAMLError) as e:
-            self.warn("Ignoring '{}' because it is malformed: {}"
-                      .format(filename, e.message))
-            return {}
+        ext = os.path.splitext(filename)[1]
+        if ext in YAML_EXTENSIONS:
+            try:
+                import yaml
+            except ImportError:
+                self.warn("Ignoring '{}' because PyYAML is not available"
+                          .format(filename))
+                return {}
+            try:
+                config = parse_cached(filename, parse_yaml)
+            except yaml.YAMLError as e:
+                self.warn("Ignoring '{}' because it is malformed: {}"
+                          .format(filename, e))
+                return {}
+        elif ext in JSON_EXTENSIONS:
+            try:
+                config = parse_cached(filename, parse_json)
+            except ValueError as e:
+                self.warn("Ignoring '{}' because it is malformed: {}"
+                          .format(filename, e))
+                return {}
+        else:
+            raise AssertionError("Unexpected file extension for file '{}'"
+                                 .format(filename))
         if not isinstance(config, dict):
             self.warn("Ignoring '{}' because it is not a map: {}"
                       .format(filename, repr(config)))
             return {}
-        for key in config:
-            if key not in self.config_keys:
-                self.warn("Ignoring unknown key '{}' from '{}'"
-                          .format(key, filename))
-                del config[key]
         return config
 
     def warn(self, msg):
         """Signal a configuration parsing or validation warning.
 
-        If warn_fatal is true, throw an error. Otherwise, print the
-        message to stderr.
+        If warn_fatal is set and true, throw an error. Otherwise,
+        print the message to stderr.
         """
-        if self.warn_fatal:
+        if getattr(self, "warn_fatal", False):
             raise AssertionError(
                 "Got warning while reading default config file: {}"
                 .format(msg))
@@ -197,65 +288,68 @@ class Config:
         the values are separated into key and value by partitioning at
         the first equals sign. If no values are specified, the value
         is set to None.
+
+        A single value without an equals sign is assigned as a string,
+        so '--foo bar' cannot be told apart from a one-element list,
+        and the list getters accept a string in place of such a list.
+        A single value with an equals sign is assigned as a map, as in
+        '--foo bar=baz'.
         """
         try:
             self.warn_fatal = False
             self.cl_config = {}
-            args = sys.argv[1:]
             key = None
             values = []
-            for arg in args + [None]:
-                if key is None:
-                    if arg is not None:
-                        self.warn("Ignoring arg '{}' with no key specified"
-                                  .format(arg))
-                elif arg is None or arg.startswith("--"):
-                    if len(values) >= 2:
-                        is_map = None
-                        for value in values:
-                            if is_map not in (None, "=" in value):
-                                self.warn(
-                                    "Ignoring command-line setting " +
-                                    "of key '{}' ".format(key) +
-                                    "due to inconsistent args '{}' and '{}'"
-                                    .format(values[0], value))
-                                is_map = None
-                                break
-                            is_map = "=" in value
-                        if is_map:
-                            value_map = {}
-                            for value in values:
-                                subkey, val = (re.match(r"^(.*?)=(.*)$", value)
-                                               .groups()[1:3])
-                                value_map[subkey] = val
-                            self.cl_config[key] = value_map
-                    elif len(values) == 1:
-                        self.cl_config[key] = values[0]
-                    else:
-                        self.cl_config[key] = None
-                    if arg is None:
-                        break
+            is_map = None
+            consistent = True
+            def flush():
+                if key is None or not consistent:
+                    return
+                if is_map:
+                    parts = (value.partition("=") for value in values)
+                    self.cl_config[key] = {
+                        subkey: val for subkey, _, val in parts}
+                elif len(values) >= 2:
+                    self.cl_config[key] = values
+                elif len(values) == 1:
+                    self.cl_config[key] = values[0]
+                else:
+                    self.cl_config[key] = None
+            for arg in sys.argv[1:]:
+                if arg.startswith("--"):
+                    flush()
                     key = arg[2:]
                     values = []
+                    is_map = None
+                    consistent = True
+                elif key is None:
+                    self.warn("Ignoring arg '{}' with no key specified"
+                              .format(arg))
                 else:
+                    has_eq = "=" in arg
+                    if is_map is None:
+                        is_map = has_eq
+                    elif consistent and has_eq != is_map:
+                        self.warn(
+                            "Ignoring command-line setting " +
+                            "of key '{}' ".format(key) +
+                            "due to inconsistent args '{}' and '{}'"
+                            .format(values[0], arg))
+                        consistent = False
                     values.append(arg)
-            for key in self.cl_config.values():
-                if key not in self.config_keys:
-                    self.warn(
-                        "Ignoring unknown key '{}' from command-line arguments"
-                        .format(key))
-                    del self.cl_config[key]
+            flush()
         finally:
             del self.warn_fatal
 
     def get_boolean(self, key):
         """Get value for key and coerce to boolean."""
         def convert(val, context):
-            if val in [True, False, None]:
+            if val in (True, False, None):
                 return val
-            elif str(val).lower() in ["y", "yes", "true", "on", "1"]:
+            val = str(val).lower()
+            if val in TRUE_STRINGS:
                 return True
-            elif str(val).upper() in ["n", "no", "false", "off", "0"]:
+            elif val in FALSE_STRINGS:
                 return False
             else:
                 raise ConfigConversionError(
@@ -263,8 +357,14 @@ class Config:
         return self.get(key, convert)
 
     def get_string(self, key):
-        """Get value for key and coerce to string."""
+        """Get value for key and coerce to string.
+
+        Lists and maps are rejected rather than converted, so that
+        their Python representation never ends up in the document.
+        """
         def convert(val, context):
+            if isinstance(val, (dict, list)):
+                raise ConfigConversionError("must be string")
             return str(val)
         return self.get(key, convert)
 
@@ -274,10 +374,16 @@ class Config:
         return self.get_string(key)
 
     def get_enum(self, key, allowed_values):
-        """Get value for key and coerce to one of allowed_values."""
+        """Get value for key and coerce to one of allowed_values.
+
+        The returned string is interned, as are the strings returned
+        by the other get_enum* methods, so that later comparisons
+        against the module-level name constants are identity checks.
+        """
+        allowed_set = frozenset(allowed_values)
         def convert(val, context):
-            val = str(val)
-            if val in allowed_values:
+            val = sys.intern(str(val))
+            if val in allowed_set:
                 return val
             else:
                 raise ConfigConversionError(
@@ -285,34 +391,56 @@ class Config:
         return self.get(key, convert)
 
     def get_string_list(self, key):
-        """Get value for key and coerce to list of strings."""
+        """Get value for key and coerce to list of strings.
+
+        A single string is treated as a list containing only that
+        string.
+        """
         def convert(vals, context):
+            if isinstance(vals, str):
+                return [vals]
+            if not isinstance(vals, list):
+                raise ConfigConversionError("must be list")
             return [str(val) for val in vals]
         return self.get(key, convert)
 
-    def get_enum_list(self, key, allowed_values, unique=False):
+    def get_enum_list(self, key, allowed_values, unique=False,
+                      allow_single=False):
         """Get value for key and coerce to list of values from allowed_values.
 
-        If unique is True, ignore duplicate values.
+        If unique is True, ignore duplicate values. A single string is
+        treated as a list containing only that string, unless
+        allow_single is True, in which case it is coerced as by
+        get_enum and returned without being wrapped in a list.
         """
+        allowed_set = frozenset(allowed_values)
         def convert(vals, context):
+            if allow_single and isinstance(vals, str):
+                val = sys.intern(vals)
+                if val in allowed_set:
+                    return val
+                raise ConfigConversionError(
+                    "must be one of: " + ", ".join(allowed_values))
+            if isinstance(vals, str):
+                vals = [vals]
             if not isinstance(vals, list):
                 raise ConfigConversionError("must be list")
             result = []
             seen = set()
             for val in vals:
-                val = str(val)
+                val = sys.intern(str(val))
                 if unique and val in seen:
                     self.warn(
                         "ignoring duplicate value '{}' for key '{}'"
                         .format(val, key) + context)
-                elif val in allowed_values:
+                elif val in allowed_set:
                     result.append(val)
                     seen.add(val)
                 else:
                     self.warn(
-                        "ignoring invalid value '{}' for key '{}': "
-                        "must be one of: " + ", ".join(allowed_values))
+                        "ignoring invalid value '{}' for key '{}'"
+                        .format(val, key) + context + ": must be one of: " +
+                        ", ".join(allowed_values))
             return result
         return self.get(key, convert)
 
@@ -322,23 +450,25 @@ class Config:
         Keys and values which are not found in allowed_keys and
         allowed_values, respectively, are ignored.
         """
+        allowed_keys_set = frozenset(allowed_keys)
+        allowed_values_set = frozenset(allowed_values)
         def convert(kv_map, context):
             if not isinstance(kv_map, dict):
                 raise ConfigConversionError("must be map")
             result = {}
             for key, val in kv_map.items():
-                key = str(key)
-                val = str(val)
+                key = sys.intern(str(key))
+                val = sys.intern(str(val))
                 if key in result:
                     self.warn(
                         "ignoring extra value '{}' for key '{}'"
                         .format(val, key) + context)
-                elif key not in allowed_keys:
+                elif key not in allowed_keys_set:
                     self.warn(
                         "ignoring value '{}' for invalid key '{}': key "
                         "key must be one of: ".format(val, key) +
                         ", ".join(allowed_keys))
-                elif val not in allowed_values:
+                elif val not in allowed_values_set:
                     self.warn(
                         "ignoring invalid value '{}' for key '{}': key "
                         "value must be one of: ".format(val, key) +
@@ -364,15 +494,12 @@ class Config:
         configuration. The first result which can be coerced
         successfully is returned. If no value is found, a UserError is
         thrown.
+
+        The key is recorded in accessed_keys, for use by warn_unused.
         """
-        sources = [
-            (self.cl_config, " from command-line arguments", False),
-            *((cfg, " from '{}'".format(fname), False)
-              for cfg, fname in self.user_configs),
-            (self.default_config, " from default config", True)
-        ]
+        self.accessed_keys.add(key)
         try:
-            for config, context, warn_fatal in sources:
+            for config, context, warn_fatal in self.sources:
                 self.warn_fatal = warn_fatal
                 if key in config and config[key] is not None:
                     try:
@@ -380,99 +507,122 @@ class Config:
                     except ConfigConversionError as e:
                         self.warn("ignoring invalid value '{}' for key '{}'"
                                   .format(config[key], key) + context + ": " +
-                                  e.message)
+                                  str(e))
             raise UserError("no value specified for key '{}'".format(key))
         finally:
             del self.warn_fatal
 
-    def ignored(self, key):
-        self.ignored.add(key)
+    def ignored(self, key, reason):
+        """Record that the value for key is ignored, and why.
 
-    def warn_ignored(self, key):
-        ... # FIXME
+        reason is a string which is used in the warning message if
+        the user has set a value for key (see warn_unused).
+        """
+        self.ignored_keys[key] = reason
 
-def generate_macro_args():
-    """Generate the value of MACRO_ARGS."""
-    args = []
-    for i in range(1, 10):
-        args.append("#" + str(i))
-    return args
+    def warn_unknown(self):
+        """Warn about user-specified keys that are not found in desc.json.
+
+        Only the command-line arguments and user-created configuration
+        files are checked. This is done as soon as all the
+        configuration has been read, so that the warnings are printed
+        even if generating the document fails.
+        """
+        try:
+            self.warn_fatal = False
+            for config, context, _ in self.sources[:-1]:
+                for key in sorted(config.keys() - self.config_keys, key=str):
+                    self.warn("Ignoring unknown key '{}'".format(key) +
+                              context)
+        finally:
+            del self.warn_fatal
 
-MACRO_ARGS = generate_macro_args()
-"""A list of strings that denote arguments in a TeX macro.
+    def warn_unused(self):
+        """Warn about user-specified keys that were marked as ignored.
 
-This is #1, #2, ..., #9.
-"""
+        See the ignored method. Only the command-line arguments and
+        user-created configuration files are checked, and only for
+        keys that were never passed to get.
+        """
+        try:
+            self.warn_fatal = False
+            for config, context, _ in self.sources[:-1]:
+                for key in sorted(config.keys() - self.accessed_keys,
+                                  key=str):
+                    if key in self.ignored_keys:
+                        self.warn("Ignoring key '{}'".format(key) + context +
+                                  " because " + self.ignored_keys[key])
+        finally:
+            del self.warn_fatal
 
-def generate_list_styles():
-    """Generate the value of LIST_STYLES."""
-    formats = [
-        "({})", "{})", "{}.",
-    ]
-    macros = {
-        "a": r"\alph*",
-        "A": r"\Alph*",
-        "i": r"\roman*",
-        "I": r"\Roman*",
-        "1": r"\arabic*",
-    }
-    list_styles = {}
-    for format in formats:
-        for key, macro in macros.items():
-            list_styles[format.format(key)] = format.format(macro)
-    return list_styles
-
-LIST_STYLES = generate_list_styles()
+MACRO_ARGS = ("#1", "#2", "#3", "#4", "#5", "#6", "#7", "#8", "#9")
+"""A tuple of strings that denote arguments in a TeX macro."""
+
+LIST_STYLES = {
+    "(a)": r"(\alph*)",
+    "(A)": r"(\Alph*)",
+    "(i)": r"(\roman*)",
+    "(I)": r"(\Roman*)",
+    "(1)": r"(\arabic*)",
+    "a)": r"\alph*)",
+    "A)": r"\Alph*)",
+    "i)": r"\roman*)",
+    "I)": r"\Roman*)",
+    "1)": r"\arabic*)",
+    "a.": r"\alph*.",
+    "A.": r"\Alph*.",
+    "i.": r"\roman*.",
+    "I.": r"\Roman*.",
+    "1.": r"\arabic*.",
+}
 r"""A map from list style strings to TeX code for package enumitem.
 
 For example, '(I)' maps to '(\Roman*)'.
 """
 
-VARIABLES = ["name", "assignment", "class", "duedate"]
-"""List of variables that might be defined by the templating engine."""
+VARIABLES = ("name", "assignment", "class", "duedate")
+"""Tuple of variables that might be defined by the templating engine."""
 
-IFS = ["clearpage"]
-"""List of if switches that might be defined by the templating engine."""
+IFS = ("clearpage",)
+"""Tuple of if switches that might be defined by the templating engine."""
 
-MACROS = ["problem", "solution", "maybeclearpage"]
-"""List of macros that might be defined by the templating engine."""
+MACROS = ("problem", "solution", "maybeclearpage")
+"""Tuple of macros that might be defined by the templating engine."""
 
-MARGINALS = VARIABLES + ["pagenumber"]
-"""List of values which can placed in the header and footer."""
+MARGINALS = VARIABLES + ("pagenumber",)
+"""Tuple of values which can placed in the header and footer."""
 
-MARGINAL_POSITIONS = [
+MARGINAL_CODE = {
+    **{variable: ("\\" + variable, True) for variable in VARIABLES},
+    "pagenumber": (r"\thepage{} of \pageref{LastPage}", False),
+}
+"""A map from each element of MARGINALS to its TeX code.
+
+Each value is a tuple of the TeX code and a boolean indicating
+whether the code refers to the variable of the same name.
+"""
+
+MARGINAL_POSITIONS = (
     "lhead", "chead", "rhead", "lfoot", "cfoot", "rfoot"
-]
-"""List of header and footer positions which can be customized."""
+)
+"""Tuple of header and footer positions which can be customized."""
 
 def sort_by(items, order):
     """Sort the items into the given order. Return a new list.
 
     All items which appear in order are sorted first, in that order,
-    followed by the remaining items, sorted in natural order.
+    followed by the remaining items, sorted in natural order. The
+    items are assumed to be distinct. If an item appears in order
+    more than once, its first position is the one that counts.
     """
-    def sort_key(item):
-        try:
-            return [order.index(item), item]
-        except ValueError:
-            return [len(order), item]
-    return sorted(items, key=sort_key)
-
-def combine_block(block):
-    """Combine a block of commands into a single string."""
-    return "\n".join(block)
-
-def combine_blocks(*groups):
-    """Combine several blocks of commands into one.
-
-    This means that blank lines are inserted between them.
-    """
-    combined = []
-    for i, group in groups:
-        if i != 0:
-            combined.append("")
-        combined.extend(group)
-    return combined
+    remaining = set(items)
+    result = []
+    for item in order:
+        if item in remaining:
+            result.append(item)
+            remaining.remove(item)
+    result.extend(sorted(remaining))
+    return result
 
 def format_marginal(content, variables):
     """Generate TeX code for the content of a marginal.
@@ -482,13 +632,13 @@ def format_marginal(content, variables):
     TeX code generated depends on a variable being defined, then add
     it to variables.
     """
-    if content in VARIABLES:
+    try:
+        code, is_variable = MARGINAL_CODE[content]
+    except KeyError:
+        raise AssertionError("Unknown content key: " + content) from None
+    if is_variable:
         variables.add(content)
-        return r"\{}".format(content)
-    elif content == "pagenumber":
-        return r"\thepage{} of \pageref{LastPage}"
-    else:
-        raise AssertionError("Unknown content key: " + content)
+    return code
 
 def format_problem(config, problem, *args):
     r"""Formatter function for problems.
@@ -496,7 +646,7 @@ def format_problem(config, problem, *args):
     Used to generate the \problem macro or to generate problems
     on-the-fly.
     """
-    return [r"\section*{{{}}}".format(problem)], 1
+    return [rf"\section*{{{problem}}}"], 1
 
 def format_solution(config, *args):
     r"""Formatter function for solutions.
@@ -506,8 +656,30 @@ def format_solution(config, *args):
     """
     return [r"\hrulefill"], 0
 
+def format_maybeclearpage(config, *args):
+    r"""Formatter function for the \maybeclearpage macro.
+
+    Starts a new page only if the clearpage switch is set.
+    """
+    return [r"\ifclearpage\clearpage\fi"], 0
+
+MACRO_FORMATTERS = {
+    "problem": format_problem,
+    "solution": format_solution,
+    "maybeclearpage": format_maybeclearpage,
+}
+"""A map from each element of MACROS to its formatter function."""
+
 def generate_document(config):
     """Given configuration, generate a document as a string."""
+    # Resolve each boolean setting at most once, since some of them
+    # are consulted repeatedly (e.g. once per problem).
+    flags = {}
+    def flag(key):
+        if key not in flags:
+            flags[key] = config.get_boolean(key)
+        return flags[key]
+
     # Declare variables that will be used to generate the very first
     # section (document class and packages).
     document_class = "article"
@@ -519,10 +691,10 @@ def generate_document(config):
     document_class_options.append(font_size + "pt")
 
     # Add conditional packages.
-    if config.get_boolean("fancy-math"):
+    if flag("fancy-math"):
         packages.append("amsmath")
         packages.append("amssymb")
-    if not config.get_boolean("indent-paragraphs"):
+    if not flag("indent-paragraphs"):
         packages.append("parskip")
 
     # Make a variable where we will put the rest of the preamble.
@@ -534,39 +706,34 @@ def generate_document(config):
     macros = set()
 
     # Create ifs and macros that don't require anything special.
-    if config.get_boolean("clearpage-option"):
+    if flag("clearpage-option"):
         ifs.add("clearpage")
         macros.add("maybeclearpage")
-    if config.get_boolean("problem-macro"):
+    if flag("problem-macro"):
         macros.add("problem")
-    if config.get_boolean("solution-macro"):
+    if flag("solution-macro"):
         macros.add("solution")
 
     # Handle fancy margins.
-    if config.get_boolean("fancy-marginals"):
+    if flag("fancy-marginals"):
         packages.append("fancyhdr")
         order = config.get_enum_list(
             "marginal-position-order", MARGINAL_POSITIONS, unique=True)
         def handle_marginals(key_name, style_name):
-            block = []
             marginals = config.get_enum_enum_map(
                 key_name, MARGINAL_POSITIONS, MARGINALS)
-            positions = sort_by(marginals.keys(), order)
-            for position in positions:
-                content = marginals[position]
-                content_code = format_marginal(content, variables)
-                block.append(r"  \{}{{{}}}".format(position, content_code))
-            if block:
-                block.sort()
-                block.insert(0, r"  \fancyhf{}")
-                block.insert(
-                    0, r"\fancypagestyle{" + style_name + "}{")
-                block.append(r"}")
-                preamble_blocks.append(block)
+            if not marginals:
+                return
+            block = [rf"\fancypagestyle{{{style_name}}}{{", r"  \fancyhf{}"]
+            for position in sort_by(marginals.keys(), order):
+                content_code = format_marginal(marginals[position], variables)
+                block.append(rf"  \{position}{{{content_code}}}")
+            block.append(r"}")
+            preamble_blocks.append(block)
         page_styles_block = []
         handle_marginals("primary-marginals", "primary")
         page_styles_block.append(r"\pagestyle{primary}")
-        if config.get_boolean("use-firstpage-marginals"):
+        if flag("use-firstpage-marginals"):
             handle_marginals("firstpage-marginals", "first")
             page_styles_block.append(r"\thispagestyle{first}")
         else:
@@ -578,71 +745,84 @@ def generate_document(config):
             config.ignored(key, "fancy-marginals was set to false")
 
     # Generate the block for page layout.
-    if config.get_boolean("fancy-page-layout"):
+    if flag("fancy-page-layout"):
         packages.append("geometry")
         margin = config.get_length("margin")
         page_layout_block = []
-        page_layout_block.append(r"\geometry[margin={}]".format(margin))
+        page_layout_block.append(rf"\geometry{{margin={margin}}}")
         preamble_blocks.append(page_layout_block)
     else:
         config.ignored("margin", "fancy-page-layout was set to false")
 
     # Generate the block for list settings.
-    if config.get_boolean("fancy-lists"):
+    if flag("fancy-lists"):
         packages.append("enumitem")
         list_styles = config.get_enum_list(
-            "list-number-style", LIST_STYLES.keys(),
+            "list-number-style", LIST_STYLES.keys(), allow_single=True,
         )
         list_block = []
-        if isinstance(list_styles, list):
-            for level, list_style in enumerate(list_styles, 1):
-                if level > 4:
-                    config.warn(
-                        "Last {} elements of list-number-style were "
-                        .format(len(list_style) - 4) + "ignored " +
-                        "(only 4 are allowed)")
-                    list_block.append(r"\setlist[enumerate,{}]{label={}}"
-                                      .format(level, LIST_STYLES[list_style]))
-            else:
-                list_block.append(r"\setlist[enumerate]{{label={}}}"
-                                  .format(LIST_STYLES[list_styles]))
-        preamble_blocks.append(list_block)
+        if isinstance(list_styles, str):
+            label = LIST_STYLES[list_styles]
+            list_block.append(rf"\setlist[enumerate]{{label={label}}}")
+        else:
+            for level, list_style in enumerate(list_styles[:4], 1):
+                label = LIST_STYLES[list_style]
+                list_block.append(
+                    rf"\setlist[enumerate,{level}]{{label={label}}}")
+            if len(list_styles) > 4:
+                config.warn(
+                    "Last {} elements of list-number-style were "
+                    .format(len(list_styles) - 4) + "ignored " +
+                    "(only 4 are allowed)")
+        if list_block:
+            preamble_blocks.append(list_block)
 
     # Make variables for the document body.
     body_blocks = []
 
     # Add preamble.
     body_blocks.append([r"\begin{document}"])
-    if config.get_boolean("use-firstpage-header"):
+    if flag("use-firstpage-header"):
         header_block = []
         header_contents = config.get_enum_list("firstpage-header", MARGINALS)
         for i, content in enumerate(header_contents):
             macro = format_marginal(content, variables)
             if i != len(header_contents) - 1:
-                header_block.append(r"  {} \\".format(macro))
+                header_block.append(rf"  {macro} \\")
             else:
-                header_block.append(r"  {}".format(macro))
+                header_block.append(f"  {macro}")
         if header_block:
             header_block.insert(0, r"\begin{flushright}")
             header_block.append(r"\end{flushright}")
             body_blocks.append(header_block)
 
-    # Add problems.
-    for i, problem in enumerate(config.get_string_list("problems")):
+    # Add problems. Their blocks are collected separately and then
+    # added to body_blocks all at once.
+    macros = frozenset(macros)
+    use_maybeclearpage = "maybeclearpage" in macros
+    use_clearpage = not use_maybeclearpage and flag("clearpage")
+    use_problem_macro = "problem" in macros
+    use_solution_macro = "solution" in macros
+    problems = config.get_string_list("problems")
+    problem_blocks = []
+    for i, problem in enumerate(problems):
         problem_block = []
         if i != 0:
-            if "maybeclearpage" in macros:
+            if use_maybeclearpage:
                 problem_block.append(r"\maybeclearpage")
-            elif config.get_boolean("clearpage"):
+            elif use_clearpage:
                 problem_block.append(r"\clearpage")
-        if "problem" in macros:
-            problem_block.append(r"\problem{{{}}}".format(problem))
+        if use_problem_macro:
+            problem_block.append(rf"\problem{{{problem}}}")
         else:
             problem_block.extend(format_problem(config, problem)[0])
-        body_blocks.append(problem_block)
-        if "solution" in macros:
-            body_blocks.append(format_solution(config)[0])
-        body_blocks.append([])
+        problem_blocks.append(problem_block)
+        if use_solution_macro:
+            problem_blocks.append([r"\solution"])
+        else:
+            problem_blocks.append(format_solution(config)[0])
+        problem_blocks.append([])
+    body_blocks.extend(problem_blocks)
 
     # Finish up.
     body_blocks.append([r"\end{document}"])
@@ -652,62 +832,65 @@ def generate_document(config):
     aggregate_blocks = []
 
     # Make document-class and packages block.
-    package_block = []
-    document_class_decl = r"\documentclass"
-    if document_class_options:
-        document_class_decl += r"[{}]".format(",".join(document_class_options))
-    document_class_decl += r"{{{}}}".format(document_class)
-    package_block.append(document_class_decl)
-    for package in packages:
-        package_block.append(r"\usepackage{{{}}}".format(package))
+    options = ",".join(document_class_options)
+    options = f"[{options}]" if options else ""
+    document_class_decl = rf"\documentclass{options}{{{document_class}}}"
+    package_block = [document_class_decl]
+    package_block.extend(
+        rf"\usepackage{{{package}}}" for package in packages)
     aggregate_blocks.append(package_block)
 
     # Make reusable list of sorted ifs.
     sorted_ifs = sort_by(ifs, config.get_enum_list("if-order", IFS))
 
     # Make the block for defining ifs.
-    if_block = []
-    for switch in sorted_ifs:
-        if_block.append(r"\newif\if{}".format(switch))
+    if_block = [rf"\newif\if{switch}" for switch in sorted_ifs]
     if if_block:
         aggregate_blocks.append(if_block)
 
     # Make the block for defining variables.
-    variable_block = []
-    for variable in sort_by(
-            variables, config.get_enum_list("variable-order", VARIABLES)):
-        value = config.get_string(variable)
-        variable_block.append(r"\newcommand{{\{\}}}{{{}}}"
-                              .format(variable, value))
+    sorted_variables = sort_by(
+        variables, config.get_enum_list("variable-order", VARIABLES))
+    variable_block = [
+        rf"\newcommand{{\{variable}}}{{{config.get_string(variable)}}}"
+        for variable in sorted_variables
+    ]
     if variable_block:
         aggregate_blocks.append(variable_block)
 
     # Make the block for setting ifs.
-    switch_block = []
-    for switch in sorted_ifs:
-        value = config.get_boolean(switch)
-        value_str = "true" if value else "false"
-        switch_block.append(r"\{}{}".format(switch, value_str))
+    switch_block = [
+        rf"\{switch}{'true' if flag(switch) else 'false'}"
+        for switch in sorted_ifs
+    ]
     if switch_block:
         aggregate_blocks.append(switch_block)
 
     # Make the block for defining autogenerated macros.
     macro_block = []
-    for macro in sort_by(macros, config.get_enum_list("macro-list", MACROS)):
-        fn = globals()["format_" + macro]
+    for macro in sort_by(macros, config.get_enum_list("macro-order", MACROS)):
+        fn = MACRO_FORMATTERS[macro]
         definition, num_args = fn(config, *MACRO_ARGS)
-        line = r"\newcommand{{\{}}}".format(macro)
+        body = "\n".join(definition)
+        line = rf"\newcommand{{\{macro}}}"
         if num_args >= 1:
-            line += r"[{}]".format(num_args)
-        line += r"{{{}}}".format(definition)
+            line += f"[{num_args}]"
+        line += f"{{{body}}}"
         macro_block.append(line)
     if macro_block:
         aggregate_blocks.append(macro_block)
 
-    # Combine blocks.
+    # Write out the blocks in one pass, with a blank line between
+    # each pair of adjacent blocks.
+    buf = io.StringIO()
     blocks = aggregate_blocks + preamble_blocks + body_blocks
-    document_block = combine_blocks(*blocks)
-    document = combine_block(document_block)
+    for i, block in enumerate(blocks):
+        if i != 0:
+            buf.write("\n")
+        if block:
+            buf.write("\n".join(block))
+            buf.write("\n")
+    document = buf.getvalue()[:-1]
 
     # Print remaining warnings.
     config.warn_unused()
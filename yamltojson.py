@@ -2,8 +2,15 @@ import json
 import sys
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 with open(sys.argv[1] + '.yml') as yaml_file:
-    with open(sys.argv[1] + '.json', 'w') as json_file:
-        json.dump(yaml.safe_load(yaml_file), json_file, indent=2,
-                  sort_keys=True)
-        json_file.write('\n')
+    data = yaml.load(yaml_file, Loader=SafeLoader)
+
+payload = json.dumps(data, indent=2, sort_keys=True).encode()
+
+with open(sys.argv[1] + '.json', 'wb') as json_file:
+    json_file.write(payload + b'\n')